@@ -11,12 +11,17 @@
     add statistics to files and index
 """
 # Std
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import functools
 import hashlib
 import html
 import io
 from itertools import groupby
 import keyword
+from operator import itemgetter
 import pathlib
+import shutil
 import sys
 import tokenize
 
@@ -33,7 +38,7 @@ from mutmut import (
 from mutmut.cache import _get_unified_diff, init_db, Mutant
 
 # other
-from pony.orm import db_session
+from pony.orm import db_session, select
 
 
 VERSION = '2024.10.0'
@@ -92,91 +97,92 @@ COMBINE_BGS = {
     },
 }
 
+STATUS2BG_TEXT = {s: (MUTANT_STATUS2TEXT[s], MUTANT_STATUS2BG[s]) for s in MUTANT_STATUS2TEXT}
+
+COMBINE_BGS_FLAT = {(a, b): v for a, ab in COMBINE_BGS.items() for b, v in ab.items()}
+
+# Plain copy of the Mutant fields needed for a report, detached from the db
+MutantInfo = namedtuple('MutantInfo', ['line_number', 'line', 'index', 'status'])
+
+_KW = frozenset(keyword.kwlist)
+_ESC = html.escape
+
 
 def create_gitignore(path):
     fp = path / '.gitignore'
     fp.write_text('# Created by htmlmut.py\n*\n')
 
 
-def begin_indent(line, start, last_pos):
-    if not line:
+def begin_indent(line_parts, start, last_pos):
+    if not line_parts:
         if start[1] > 0:
-            line += f'{start[1] * " "}'
+            return start[1] * ' '
     else:
         if start[1] > last_pos:
-            line += f'{(start[1] - last_pos) * " "}'
-    return line
-
-
-def span(text, key):
-    return f'<span class="{key}">{html.escape(text)}</span>'
-
-
-def span_key(val):
-    return span(val, 'k')
-
+            return (start[1] - last_pos) * ' '
+    return ''
 
-def span_str(val):
-    return span(val, 's')
 
-
-def span_num(val):
-    return span(val, 'n')
-
-
-def span_cmt(val):
-    return span(val, 'c')
-
-
-def handle_token(out, line, toknum, tokval, start, stop):
-    if toknum == tokenize.NAME and keyword.iskeyword(tokval):
-        line += span_key(tokval)
+def handle_token(out, line_parts, toknum, tokval, start, stop, _esc=_ESC):
+    # NAME and NUMBER tokens never contain characters that need escaping
+    if toknum == tokenize.NAME:
+        if tokval in _KW:
+            line_parts.append(f'<span class="k">{tokval}</span>')
+        else:
+            line_parts.append(tokval)
     elif toknum == tokenize.NUMBER:
-        line += span_num(tokval)
+        line_parts.append(f'<span class="n">{tokval}</span>')
     elif toknum == tokenize.STRING:
         if stop[0] > start[0]:
             # multiline string
             mline = tokval.splitlines()
-            line += span_str(mline[0])
-            out += [f'{line}']
-            line = ''
+            line_parts.append(f'<span class="s">{_esc(mline[0])}</span>')
+            out.append(''.join(line_parts))
+            line_parts.clear()
             for deltaline in mline[1:-1]:
-                line += span_str(deltaline)
-                out += [f'{line}']
-                line = ''
-            line = span_str(mline[-1])
+                out.append(f'<span class="s">{_esc(deltaline)}</span>')
+            line_parts.append(f'<span class="s">{_esc(mline[-1])}</span>')
         else:
-            line += span_str(tokval)
+            line_parts.append(f'<span class="s">{_esc(tokval)}</span>')
     elif toknum == tokenize.COMMENT:
-        line += span_cmt(tokval)
+        line_parts.append(f'<span class="c">{_esc(tokval)}</span>')
     elif toknum in (tokenize.NL, tokenize.NEWLINE, tokenize.ENDMARKER):
-        out += [f'{line}']
-        line = ''
+        out.append(''.join(line_parts))
+        line_parts.clear()
     else:
-        line += f'{html.escape(tokval)}'
-    return line
+        line_parts.append(_esc(tokval))
 
 
 def highlight_code(source):
     """Highlights source code using HTML."""
     fp = io.StringIO(source)
 
+    # source is already decoded text, tokenize.tokenize() over bytes is no faster
+    # and would re-decode according to any coding cookie in the file
     tokens = tokenize.generate_tokens(fp.readline)
     out = []
-    line = ''
+    line_parts = []
     try:
         last_pos = 0
         for toknum, tokval, start, stop, _ in tokens:
-            line = begin_indent(line, start, last_pos)
+            indent = begin_indent(line_parts, start, last_pos)
+            if indent:
+                line_parts.append(indent)
             last_pos = stop[1]
-            line = handle_token(out, line, toknum, tokval, start, stop)
-        if line:
-            out += [f'{line}']
+            handle_token(out, line_parts, toknum, tokval, start, stop)
+        if line_parts:
+            out.append(''.join(line_parts))
     except tokenize.TokenError as exc:
-        out += [f'{exc}']
+        out.append(f'{exc}')
     return out
 
 
+@functools.lru_cache(maxsize=4096)
+def _highlight_cached(source):
+    """Memoized highlight_code for the short, often repeated, mutation snippets."""
+    return tuple(highlight_code(source))
+
+
 def get_added_lines(text):
     result = []
     for line in text.splitlines():
@@ -189,129 +195,174 @@ def create_hashed_html_filename(file_path, out_path, prefix='zz_'):
     fn = pathlib.Path(file_path).resolve()
     p = f'{fn.parent}'.encode('utf-8')
     name = fn.name.replace('.', '_')
-    m = hashlib.md5()
-    m.update(p)
+    digest = hashlib.blake2b(p, digest_size=6).hexdigest()
 
-    out_fn = f'{prefix}{m.hexdigest()[-12:]}_{name}.html'
+    out_fn = f'{prefix}{digest}_{name}.html'
     return out_path / out_fn
 
 
 def copy_file_to_hashed_name(file_path, out_path, prefix='zx_'):
-    buf = file_path.read_text()
-    m = hashlib.md5()
-    m.update(buf.encode('utf-8'))
-    r_path = out_path / f'{prefix}{m.hexdigest()[-12:]}_{file_path.name}'
-    r_path.write_text(buf)
+    with file_path.open('rb') as f:
+        digest = hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=6)).hexdigest()
+    r_path = out_path / f'{prefix}{digest}_{file_path.name}'
+    shutil.copyfile(file_path, r_path)
     return r_path
 
 
-def get_mutations_for_each_line(mutants, source, filename, dict_synonyms):
+def get_mutations_for_each_line(mutants, source, filename, dict_synonyms, added_lines_cache=None):
+    """added_lines_cache maps (line_number, index, line) to the added lines of that
+    mutation, it can be shared between files with identical source."""
+    if added_lines_cache is None:
+        added_lines_cache = {}
+    mutants = sorted(mutants, key=lambda m: (m.line_number, m.index))
+    line2mutants = {ln: list(g) for ln, g in groupby(mutants, key=lambda m: m.line_number)}
+
+    # line number -> (statuses, indices, added lines), one list per field
     line2mutations = {}
-    for mutant in sorted(mutants, key=lambda m: m.id):
-        diff = _get_unified_diff(
-            source,
-            filename,
-            RelativeMutationID(mutant.line.line, mutant.index, mutant.line.line_number),
-            dict_synonyms,
-            update_cache=False,
-        )
-        if mutant.line.line_number not in line2mutations:
-            line2mutations[mutant.line.line_number] = []
-        if mutant.index == len(line2mutations[mutant.line.line_number]):
-            line2mutations[mutant.line.line_number] += [[mutant, get_added_lines(diff)]]
-        else:
-            print(
-                f'Error, lost mutation: ln = {mutant.line.line_number}:{mutant.index}'
-                f'{mutant.line.line}'
-            )
+    for line_number, line_mutants in line2mutants.items():
+        statuses = []
+        indices = []
+        diffs = []
+        for mutant in line_mutants:
+            key = (line_number, mutant.index, mutant.line)
+            added_lines = added_lines_cache.get(key)
+            if added_lines is None:
+                diff = _get_unified_diff(
+                    source,
+                    filename,
+                    RelativeMutationID(mutant.line, mutant.index, line_number),
+                    dict_synonyms,
+                    update_cache=False,
+                )
+                added_lines = get_added_lines(diff)
+                added_lines_cache[key] = added_lines
+            statuses.append(mutant.status)
+            indices.append(mutant.index)
+            diffs.append(added_lines)
+        line2mutations[line_number] = (statuses, indices, diffs)
     return line2mutations
 
 
 @init_db
 @db_session
-def create_html_report(dict_synonyms, directory):
-    global html_content
+def load_mutants():
+    """Fetch (filename, line_number, line, index, status) for every mutant in one query."""
+    rows = select(
+        (m.line.sourcefile.filename, m.line.line_number, m.line.line, m.index, m.status)
+        for m in Mutant
+    )[:]
+    return sorted(rows, key=itemgetter(0, 1, 3))
+
 
-    mutants = sorted(list((x for x in Mutant.select())), key=lambda x: x.line.sourcefile.filename)
+def create_html_report(dict_synonyms, directory, max_workers=None):
+    rows = load_mutants()
 
     dir_path = pathlib.Path(directory).resolve()
     dir_path.mkdir(parents=True, exist_ok=True)
 
     this_dir_path = pathlib.Path(__file__).parent
+    template = html_content
     for name in ('htmlmut.js', 'htmlmut.css'):
         new_name = copy_file_to_hashed_name(this_dir_path / name, dir_path)
-        html_content = html_content.replace(name, new_name.name)
+        template = template.replace(name, new_name.name)
+    prefix, _, suffix = template.partition('{highlighted_code}')
     create_gitignore(dir_path)
 
     index_data = [
-        '<h1>Mutation files</h1>',
+        '<h1>Mutation files</h1>\n',
         # f'Killed {len([x for x in mutants if x.status == OK_KILLED])}
         # out of {len(mutants)} mutants',
-        '<table><thead><tr><th>File</th></thead>',
+        '<table><thead><tr><th>File</th></thead>\n',
     ]
     # <th>Total</th><th>Skipped</th><th>Killed</th><th>% killed</th><th>Survived</th>
 
-    for filename, mutants in groupby(mutants, key=lambda x: x.line.sourcefile.filename):
-        print(filename)
-
+    # Files with identical content (vendored copies etc.) are grouped on a digest
+    # of the source so that it is only diffed and highlighted once
+    digest2files = {}
+    for filename, file_rows in groupby(rows, key=itemgetter(0)):
         report_path = create_hashed_html_filename(filename, dir_path)
 
-        index_data += [f'<tr><td><a href="{report_path.name}">{filename}</a></td></tr>']
+        index_data.append(f'<tr><td><a href="{report_path.name}">{filename}</a></td></tr>\n')
+
+        infos = [MutantInfo(*row[1:]) for row in file_rows]
+        with open(filename, 'rb') as f:
+            digest = hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).digest()
+        digest2files.setdefault(digest, []).append((filename, infos, report_path))
 
-        in_path = pathlib.Path(filename)
+    tasks = [(files, dict_synonyms, prefix, suffix) for files in digest2files.values()]
 
-        source = in_path.read_text()
+    # Sources are independent of each other, render them on all cores
+    with ProcessPoolExecutor(max_workers) as executor:
+        for filenames in executor.map(_render_same_source, tasks):
+            for filename in filenames:
+                print(filename)
 
-        line2mutations = get_mutations_for_each_line(mutants, source, filename, dict_synonyms)
+    index_data.append('</table></body></html>\n')
 
-        hl_code = highlight_code(source)
+    index_path = dir_path / 'index.html'
+    with index_path.open('w') as fh:
+        fh.writelines(index_data)
 
-        create_html_from_source(hl_code, line2mutations, report_path)
 
-    index_data += ['</table></body></html>']
+def _render_same_source(task):
+    files, dict_synonyms, prefix, suffix = task
 
-    index_path = dir_path / 'index.html'
-    index_path.write_text('\n'.join(index_data) + '\n')
+    in_path = pathlib.Path(files[0][0])
 
+    source = in_path.read_text()
 
-def create_html_from_source(hl_code, line2mutations, report_path):
-    line_no = -1
-    result = ''
+    hl_code = highlight_code(source)
+
+    # The added lines only depend on the source and the mutation id, the filename
+    # only shows up in the diff header that get_added_lines drops
+    added_lines_cache = {}
+    for filename, mutants, report_path in files:
+        line2mutations = get_mutations_for_each_line(
+            mutants, source, filename, dict_synonyms, added_lines_cache
+        )
+        create_html_from_source(hl_code, line2mutations, report_path, prefix, suffix)
+    return [filename for filename, _, _ in files]
+
+
+def create_html_from_source(hl_code, line2mutations, report_path, prefix, suffix):
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with report_path.open('w', buffering=1 << 16) as fh:
+        fh.write(prefix)
+        write_highlighted_code(fh, hl_code, line2mutations)
+        fh.write(suffix)
+
+
+def write_highlighted_code(fh, hl_code, line2mutations):
     mut_no = 0
     ln_w = len(f'{len(hl_code)}') + 1
-    for line in hl_code:
-        line_no += 1
-        muts = ''
-        txt_cls = BG_GRAY
-        if line_no in line2mutations:
-            index = 0
-            muts += f'<div class="mts" id="d{line_no}" style="display: none;">\n'
-            for mutant, item in line2mutations[line_no]:
-                st = MUTANT_STATUS2TEXT.get(mutant.status, '--ERROR--')
-                bg = MUTANT_STATUS2BG.get(mutant.status, BG_RED)
-                txt_cls = COMBINE_BGS.get(txt_cls, {}).get(bg, BG_RED)
+    ln_pad = ln_w * ' '
+    for line_no, line in enumerate(hl_code):
+        muts_for_line = line2mutations.get(line_no)
+        if muts_for_line is not None:
+            txt_cls = BG_GRAY
+            muts_parts = [f'<div class="mts" id="d{line_no}" style="display: none;">\n']
+            statuses, indices, diffs = muts_for_line
+            for status, index, item in zip(statuses, indices, diffs):
+                st, bg = STATUS2BG_TEXT.get(status, ('--ERROR--', BG_RED))
+                # red absorbs every other background
+                if txt_cls != BG_RED:
+                    txt_cls = COMBINE_BGS_FLAT.get((txt_cls, bg), BG_RED)
                 mut_no += 1
-                hl_item = highlight_code(item)
-                muts += (
-                    f'<p class="mt {bg}"><span class="ln">{ln_w * " "} </span>{hl_item[0]}'
+                hl_item = _highlight_cached(item)
+                muts_parts.append(
+                    f'<p class="mt {bg}"><span class="ln">{ln_pad} </span>{hl_item[0]}'
                     f'<span class="r">{st} mt #{mut_no} ndx {index}</span></p>\n'
                 )
-                index += 1
-            muts += '</div>\n'
+            muts_parts.append('</div>\n')
             txt_cls = txt_cls.replace('bg', 'txt')
-        if line_no in line2mutations:
             mut = (
                 f'<span class="r {txt_cls}" onclick="toggle(\'d{line_no}\');">'
-                f'#mts {len(line2mutations[line_no])}</span>'
+                f'#mts {len(statuses)}</span>'
             )
+            fh.write(f'<p><span class="ln">{line_no + 1:{ln_w}} </span>{line}{mut}</p>\n')
+            fh.writelines(muts_parts)
         else:
-            mut = ''
-        result += f'<p><span class="ln">{line_no + 1:{ln_w}} </span>{line}{mut}</p>\n'
-        result += muts
-    output = html_content.format(highlighted_code=result)
-
-    report_path.parent.mkdir(parents=True, exist_ok=True)
-    report_path.write_text(output)
+            fh.write(f'<p><span class="ln">{line_no + 1:{ln_w}} </span>{line}</p>\n')
 
 
 def _main(arguments):